@@ -2,14 +2,33 @@
 import os
 import re
 import csv
+import io
 import json
+import urllib.parse
 import logging
-from datetime import datetime, timedelta
+import functools
+import heapq
+import itertools
+import queue
+import threading
+import time
+import atexit
+import signal
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from decimal import Decimal, ROUND_HALF_UP
 
+import requests
 import telebot
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from urllib3.util.retry import Retry
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-import stripe
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
 
 # ----------------------------------------------------------------------
 # Token / Environment / Config Setup
@@ -33,12 +52,47 @@ if not TOKEN:
 MAINTENANCE = os.getenv("MAINTENANCE", "false").lower() == "true"
 ENV = os.getenv("ENV", "dev")  # dev / prod
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+# Local address for the webhook server (typically behind a TLS reverse proxy)
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+# Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; random if unset
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+if WEBHOOK_URL:
+    # run_webhooks serves "/<path>/" (trailing slash added) but registers the
+    # URL with Telegram as given, and Telegram won't follow a redirect, so
+    # both are derived from the same slash-terminated path
+    WEBHOOK_PATH = urllib.parse.urlparse(WEBHOOK_URL).path.strip("/") + "/"
+    if WEBHOOK_PATH == "/":
+        raise ValueError("❌ WEBHOOK_URL needs a path, e.g. https://example.com/telegram")
+    WEBHOOK_URL = WEBHOOK_URL.rstrip("/") + "/"
 
 # Session timeout for cart / checkout flows
 SESSION_TIMEOUT_SECONDS = 3600  # 1 hour
+SESSION_SWEEP_INTERVAL = 300  # how often abandoned sessions are freed
+MAX_ACTIVE_SESSIONS = 10000  # least recently active users beyond this are evicted
+# Updates are handled on a pool of worker threads; each one spends most of
+# its time blocked on Telegram HTTP round-trips, so allow plenty in flight
+# (one user's updates still run one at a time, see per_user)
+HANDLER_THREADS = int(os.getenv("HANDLER_THREADS", "16"))
+
+# One keep-alive HTTP session for every Telegram API call, shared across
+# handler/worker threads, so each send reuses a warm TLS connection.
+# Only connection failures are retried (never a POST that reached Telegram).
+_http = requests.Session()
+_http.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        max_retries=Retry(total=2, backoff_factor=0.3),
+    ),
+)
+apihelper.session = _http
+apihelper.SESSION_TIME_TO_LIVE = None
 
 # Initialize bot
-bot = telebot.TeleBot(TOKEN)
+bot = telebot.TeleBot(TOKEN, num_threads=HANDLER_THREADS)
 
 # ----------------------------------------------------------------------
 # Load configuration (shop, catalog, admins, delivery, Stripe)
@@ -54,6 +108,8 @@ SYMBOL = cfg.get("symbol", "£")
 # Delivery configuration
 DELIVERY_FEE = Decimal(str(cfg.get("delivery_fee", "2.50")))
 FREE_DELIVERY_THRESHOLD = Decimal(str(cfg.get("free_delivery_threshold", "10.00")))
+DELIVERY_FEE_PENCE = int((DELIVERY_FEE * 100).to_integral_value(ROUND_HALF_UP))
+FREE_DELIVERY_THRESHOLD_PENCE = int((FREE_DELIVERY_THRESHOLD * 100).to_integral_value(ROUND_HALF_UP))
 
 # Admin / notifications
 ADMIN_IDS = cfg.get("admin_ids", [])
@@ -73,7 +129,15 @@ if not STRIPE_SECRET_KEY:
 SUCCESS_URL = cfg.get("success_url", "https://example.com/success")
 CANCEL_URL = cfg.get("cancel_url", "https://example.com/cancel")
 
-stripe.api_key = STRIPE_SECRET_KEY or None
+
+@functools.lru_cache(maxsize=1)
+def _stripe():
+    """Import and configure the Stripe SDK on first use (keeps cold start fast)."""
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY or None
+    return stripe
+
+
 # Catalog configuration
 raw_catalog = cfg.get("catalog", {})
 catalog = {}
@@ -83,8 +147,62 @@ for name, data in raw_catalog.items():
         "emoji": data.get("emoji", ""),
         "image": data.get("image", ""),
         "price": price,
+        "price_pence": int((price * 100).to_integral_value(ROUND_HALF_UP)),
     }
 
+# Flat lookups for the hot paths (one hash lookup per attribute)
+_PRICE_PENCE = {name: data["price_pence"] for name, data in catalog.items()}
+_EMOJI = {name: data["emoji"] for name, data in catalog.items()}
+_CATALOG_NAMES = tuple(catalog.keys())
+
+# The /order keyboard only depends on the catalog, so build and serialize it once
+_ORDER_KB = InlineKeyboardMarkup(row_width=2)
+for name in _CATALOG_NAMES:
+    _ORDER_KB.add(InlineKeyboardButton(f"{_EMOJI[name]} {name}", callback_data=f"add|{name}"))
+# Persistent Open Cart button (replaces Checkout in catalog view)
+_ORDER_KB.add(InlineKeyboardButton("🛒 Open Cart", callback_data="open_cart"))
+_ORDER_KB_JSON = _ORDER_KB.to_json()
+
+# Likewise the /order menu text, which only depends on the catalog and fees
+_ORDER_MENU_TEXT = (
+    "🛍 *Our Stickers:*\n\n"
+    + "".join(
+        f"{_EMOJI[name]} {name} — {SYMBOL}{catalog[name]['price']:.2f}\n"
+        for name in _CATALOG_NAMES
+    )
+    + f"\n🚚 Delivery: {SYMBOL}{DELIVERY_FEE:.2f} "
+    f"(free over {SYMBOL}{FREE_DELIVERY_THRESHOLD:.2f})\n"
+    "Tap a button below to add to your cart 👇"
+)
+
+# Static keyboards for the cart / checkout flow
+_CART_KB_ITEMS = InlineKeyboardMarkup()
+_CART_KB_ITEMS.add(
+    InlineKeyboardButton("✅ Checkout", callback_data="begin_checkout"),
+    InlineKeyboardButton("🛍 Continue Shopping", callback_data="continue_order"),
+    InlineKeyboardButton("🗑 Clear Cart", callback_data="clear_cart"),
+)
+
+_CONTINUE_KB = InlineKeyboardMarkup()
+_CONTINUE_KB.add(InlineKeyboardButton("🛍 Continue Shopping", callback_data="continue_order"))
+_CART_KB_EMPTY = _CONTINUE_KB
+
+_BACK_KB = InlineKeyboardMarkup()
+_BACK_KB.add(InlineKeyboardButton("↩️ /back", callback_data="back"))
+
+_REVIEW_KB = InlineKeyboardMarkup()
+_REVIEW_KB.add(
+    InlineKeyboardButton("✅ Confirm", callback_data="confirm_details"),
+    InlineKeyboardButton("✏️ Edit Address", callback_data="edit_address"),
+    InlineKeyboardButton("↩️ /back", callback_data="back"),
+)
+
+# Shared second row of the Pay Now keyboard (the URL button is per order)
+_ANOTHER_ORDER_BUTTON = InlineKeyboardButton("🛍 Make Another Order", callback_data="continue_order")
+
+_ANOTHER_ORDER_KB = InlineKeyboardMarkup()
+_ANOTHER_ORDER_KB.add(_ANOTHER_ORDER_BUTTON)
+
 # ----------------------------------------------------------------------
 # In-memory data stores
 # ----------------------------------------------------------------------
@@ -95,14 +213,18 @@ user_carts = {}
 # Checkout state: user_id -> { "step": int, "data": {...} }
 user_states = {}
 
-# Last user activity for timeout: user_id -> datetime
-last_activity = {}
+# Last user activity for timeout: user_id -> time.monotonic() seconds.
+# Kept in least- to most-recently-active order; doubles as the LRU index.
+last_activity = OrderedDict()
+# Re-entrant: update_activity and the sweeper clear sessions while holding it
+_session_lock = threading.RLock()
 
 # Track menu messages so we can mark them outdated: user_id -> [(chat_id, msg_id), ...]
 user_menu_messages = {}
 
 # Track the single "live" cart message per user for inline refresh:
-# user_id -> (chat_id, msg_id)
+# user_id -> (chat_id, msg_id, text last rendered into it); msg_id is None
+# while a new cart message is still queued, and text is then the latest cart
 user_cart_message = {}
 
 # Delivery flow configuration
@@ -121,48 +243,417 @@ delivery_prompts = {
 
 csv_filename = "orders.csv"
 
+# Fixed column order for orders.csv; rows are written as tuples in this order
+_ORDER_COLS = (
+    "order_id",
+    "username",
+    "items",
+    "name",
+    "house",
+    "street",
+    "city",
+    "postcode",
+    "status",
+    "date",
+    "order_total",
+    "currency",
+)
+
 if not os.path.exists(csv_filename) or os.path.getsize(csv_filename) == 0:
     # Create file with headers
     with open(csv_filename, "w", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            "order_id",
-            "username",
-            "items",
-            "name",
-            "house",
-            "street",
-            "city",
-            "postcode",
-            "status",
-            "date",
-            "order_total",
-            "currency",
-        ])
+        csv.writer(f).writerow(_ORDER_COLS)
+
+# Header as actually stored (older files may predate some columns)
+with open(csv_filename, "r", newline="", encoding="utf-8") as f:
+    _CSV_HEADER = next(csv.reader(f), list(_ORDER_COLS))
+
+# Bytes read from the end of orders.csv when listing recent orders
+TAIL_READ_BYTES = 8192
+_ORDER_ROW_DEFAULTS = dict.fromkeys(_ORDER_COLS, "")
+
+
+def read_last_orders(n):
+    """Return the last n order rows as dicts, reading only the file's tail."""
+    with open(csv_filename, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        start = max(0, f.tell() - TAIL_READ_BYTES)
+        f.seek(start)
+        chunk = f.read().decode("utf-8", errors="replace")
+    if start:
+        # Landed mid-row: skip to the next line break
+        chunk = chunk.partition("\n")[2]
+    # Parse whole records, since quoted fields may hold newlines of their own
+    records = [rec for rec in csv.reader(io.StringIO(chunk, newline="")) if rec]
+    if not start:
+        records = records[1:]  # header
+    rows = []
+    for rec in records[-n:]:
+        # Rows appended after columns were added outgrow an older header;
+        # columns are only ever appended, so _ORDER_COLS labels them
+        cols = _CSV_HEADER if len(rec) <= len(_CSV_HEADER) else _ORDER_COLS
+        # Columns an older row lacks read as blank
+        rows.append({**_ORDER_ROW_DEFAULTS, **dict(zip(cols, rec))})
+    return rows
+
+
+# Long-lived append handle, owned by the _csv_worker thread
+_orders_fh = open(csv_filename, "a", newline="", encoding="utf-8")
+_orders_writer = csv.writer(_orders_fh)
+
+# Rows waiting to be appended; None tells the worker to stop
+_csv_queue = queue.Queue()
+CSV_FLUSH_INTERVAL = 1.0  # seconds
+
+
+def write_order(fields):
+    """Queue one order row (a tuple in _ORDER_COLS order) for the CSV."""
+    _csv_queue.put(fields)
+
+
+def _csv_worker():
+    """Append queued rows, flushing at most once per CSV_FLUSH_INTERVAL."""
+    # Rows taken off the queue but not yet handed to the writer; a failed
+    # write leaves them here to be retried instead of dropping the order
+    pending = deque()
+    dirty = False
+    last_flush = time.monotonic()
+    while True:
+        try:
+            row = _csv_queue.get(timeout=CSV_FLUSH_INTERVAL)
+        except queue.Empty:
+            row = ()
+        if row is None:
+            break
+        if row:
+            pending.append(row)
+        try:
+            while pending:
+                _orders_writer.writerow(pending[0])
+                pending.popleft()
+                dirty = True
+            if dirty and time.monotonic() - last_flush >= CSV_FLUSH_INTERVAL:
+                _orders_fh.flush()
+                os.fsync(_orders_fh.fileno())
+                dirty = False
+                last_flush = time.monotonic()
+        except OSError:
+            # Disk full / I/O error: keep the thread alive and retry next tick
+            logger.exception(
+                "Writing %s failed; retrying (%d row(s) not yet written)", csv_filename, len(pending)
+            )
+    try:
+        for row in pending:
+            _orders_writer.writerow(row)
+        _orders_fh.close()
+    except OSError:
+        logger.exception("Flushing %s on shutdown failed; recent orders may be missing", csv_filename)
+
+
+_csv_thread = threading.Thread(target=_csv_worker, name="csv-writer", daemon=True)
+_csv_thread.start()
+
+
+@atexit.register
+def _close_orders_csv():
+    """Drain pending rows and close orders.csv on shutdown."""
+    _csv_queue.put(None)
+    _csv_thread.join(timeout=5)
+
 
 # ----------------------------------------------------------------------
 # Order counter for friendly IDs
 # ----------------------------------------------------------------------
 
 counter_file = "order_counter.json"
+# Appended with one "YYMMDD count" line per order, then folded back into
+# counter_file, so an order never rewrites every past day's count
+counter_log_file = "order_counter.log"
+COUNTER_LOG_COMPACT_LINES = 1000  # log lines that trigger a compaction
+
+
+def _load_order_counters():
+    """Read the counter snapshot, then replay the order log on top of it."""
+    counters = {}
+    if os.path.exists(counter_file):
+        with open(counter_file, "r", encoding="utf-8") as f:
+            counters = json.load(f)
+    if os.path.exists(counter_log_file):
+        with open(counter_log_file, "r", encoding="utf-8") as f:
+            for line in f:
+                day, _, count = line.strip().partition(" ")
+                # A line torn by a crash mid-append is skipped
+                if len(day) == 6 and count.isdigit():
+                    counters[day] = max(counters.get(day, 0), int(count))
+    return counters
+
+
+def _fsync_dir(path):
+    """Make a rename of path durable by syncing its directory (POSIX only)."""
+    if os.name == "nt":
+        return  # directories can't be opened for fsync; NTFS renames are journaled
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _compact_order_counters():
+    """Write every day's count to counter_file and empty the order log."""
+    global _counter_log_lines
+    # Write, fsync, then rename, so neither a crash nor a power cut can
+    # leave the counters empty and order numbers reissued
+    tmp_file = counter_file + ".tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(order_counters, f, separators=(",", ":"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, counter_file)
+    _fsync_dir(counter_file)
+    # Only once the snapshot is durable; replaying a log it already covers
+    # is harmless, since the load keeps the highest count per day
+    _counter_log.truncate(0)
+    os.fsync(_counter_log.fileno())
+    _counter_log_lines = 0
+
+
+order_counters = _load_order_counters()
+_counter_log = open(counter_log_file, "a", encoding="utf-8")
+_counter_log_lines = 0
+_compact_order_counters()
+
+
+# ((year, month, day), "YYMMDD") for the current day only; swapped in as one
+# tuple so a concurrent reader never pairs a new key with yesterday's string
+_today_cache = (None, None)
+
+
+def _today_str():
+    """Return today's date as YYMMDD, formatting it once per day."""
+    global _today_cache
+    now = datetime.now()
+    key = (now.year, now.month, now.day)
+    cached = _today_cache
+    if cached[0] != key:
+        cached = (key, now.strftime("%y%m%d"))
+        _today_cache = cached
+    return cached[1]
 
-if os.path.exists(counter_file):
-    with open(counter_file, "r", encoding="utf-8") as f:
-        order_counters = json.load(f)
-else:
-    order_counters = {}
+
+# Handlers run on several threads; two orders must never share a number
+_counter_lock = threading.Lock()
 
 
 def generate_order_id():
     """Create a friendly order ID: ORD-YYMMDD-XX"""
-    today = datetime.now().strftime("%y%m%d")
-    count = order_counters.get(today, 0) + 1
-    order_counters[today] = count
-    with open(counter_file, "w", encoding="utf-8") as f:
-        json.dump(order_counters, f)
+    global _counter_log_lines
+    with _counter_lock:
+        # Read the date under the lock, so orders straddling midnight are
+        # numbered in the order they take the lock
+        today = _today_str()
+        # Past days stay in the counters, so a clock set back a day carries
+        # on from that day's count instead of reissuing its numbers
+        count = order_counters.get(today, 0) + 1
+        order_counters[today] = count
+        # Durable before the number is handed out
+        _counter_log.write(f"{today} {count}\n")
+        _counter_log.flush()
+        os.fsync(_counter_log.fileno())
+        _counter_log_lines += 1
+        if _counter_log_lines >= COUNTER_LOG_COMPACT_LINES:
+            _compact_order_counters()
     return f"ORD-{today}-{count:02d}"
 
 
+# ----------------------------------------------------------------------
+# Outgoing rate limiting (Telegram flood control)
+# ----------------------------------------------------------------------
+
+# Per-chat token bucket plus a global sliding window, per Bot API limits
+PER_CHAT_RATE = 1.0  # sustained messages per second in one chat
+PER_CHAT_BURST = 3  # messages a chat may receive back-to-back
+GLOBAL_RATE = 30  # messages per second across all chats
+# A send whose chat slot isn't free yet goes on that chat's outbox, which the
+# outbox threads deliver in order, so no handler thread sleeps on one chat.
+# Idempotent redraws (cart edits, outdated-menu edits) pass redraw=True and
+# are skipped instead when their slot is further off than MAX_CHAT_WAIT; the
+# next user action redraws them anyway. Everything else always queues.
+MAX_CHAT_WAIT = 2.0  # seconds
+# Sends queued for one chat before further ones are dropped (a flooding chat);
+# admin notifications pass capped=False and are never dropped
+OUTBOX_MAX_PER_CHAT = 200
+# Threads delivering queued sends; each chat has at most one request in
+# flight, so a stalled request holds up only its own chat
+OUTBOX_THREADS = 4
+OUTBOX_DRAIN_TIMEOUT = 2.0  # seconds allowed at shutdown for queued sends
+
+# chat_id -> (tokens, last_refill); tokens go negative to book slots for
+# sends already queued for that chat
+_chat_buckets = {}
+# Send times within the last second, oldest first
+_global_sends = deque()
+_rl_lock = threading.Lock()
+
+# chat_id -> deque of (due, fn, args, kwargs, on_sent, on_error) sends queued
+# for that chat, oldest first; the head stays until it has been delivered
+_outbox_chats = {}
+# Heap of (due, seq, chat_id) for chats whose head send is waiting for a
+# thread, i.e. queued chats with nothing in flight
+_outbox = []
+_outbox_seq = itertools.count()
+_outbox_cv = threading.Condition(_rl_lock)
+
+
+def _book_chat_slot(chat_id, redraw):
+    """Book chat_id's next send slot; seconds until it, or None to skip a redraw."""
+    now = time.monotonic()
+    tokens, last = _chat_buckets.get(chat_id, (PER_CHAT_BURST, now))
+    tokens = min(PER_CHAT_BURST, tokens + (now - last) * PER_CHAT_RATE)
+    wait = max(0.0, (1 - tokens) / PER_CHAT_RATE)
+    if redraw and wait > MAX_CHAT_WAIT:
+        _chat_buckets[chat_id] = (tokens, now)
+        return None
+    _chat_buckets[chat_id] = (tokens - 1, now)
+    if len(_chat_buckets) > MAX_ACTIVE_SESSIONS:
+        # Buckets that have refilled and have nothing queued carry no state
+        for cid, (t, ts) in list(_chat_buckets.items()):
+            if cid not in _outbox_chats and t + (now - ts) * PER_CHAT_RATE >= PER_CHAT_BURST:
+                del _chat_buckets[cid]
+    return wait
+
+
+def _wait_for_global_slot():
+    """Wait (under a second) for room in the global send window."""
+    while True:
+        with _rl_lock:
+            now = time.monotonic()
+            while _global_sends and now - _global_sends[0] >= 1.0:
+                _global_sends.popleft()
+            if len(_global_sends) < GLOBAL_RATE:
+                _global_sends.append(now)
+                return
+            wait = 1.0 - (now - _global_sends[0])
+        time.sleep(wait)
+
+
+def _deliver(fn, args, kwargs, on_sent, on_error):
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        if on_error is None:
+            raise
+        on_error(e)
+        return None
+    if on_sent:
+        on_sent(result)
+    return result
+
+
+def _rl_call(chat_id, fn, args, kwargs, redraw=False, capped=True, on_sent=None, on_error=None):
+    """Call fn now if chat_id has a free slot, else queue it on the chat's outbox.
+
+    Returns fn's result when it ran straight away, None when queued, skipped
+    or dropped. on_sent, if given, receives the result either way once fn has
+    run; on_error receives the exception if fn fails, or queue.Full if the
+    send is dropped (a queued send without one is logged).
+    """
+    with _rl_lock:
+        pending = _outbox_chats.get(chat_id)
+        queued = len(pending) if pending else 0
+        dropped = capped and queued >= OUTBOX_MAX_PER_CHAT
+        if not dropped:
+            wait = _book_chat_slot(chat_id, redraw)
+            if wait is None:
+                logger.info("Skipped redraw in chat %s: over its rate limit", chat_id)
+                return None
+            if wait or pending:
+                # Behind this chat's earlier sends; keep their order
+                due = time.monotonic() + wait
+                if pending is None:
+                    pending = _outbox_chats[chat_id] = deque()
+                    heapq.heappush(_outbox, (due, next(_outbox_seq), chat_id))
+                    _outbox_cv.notify()
+                pending.append((due, fn, args, kwargs, on_sent, on_error))
+                return None
+
+    if dropped:
+        logger.warning("Dropped send to chat %s: %d already queued", chat_id, queued)
+        if on_error:
+            on_error(queue.Full())
+        return None
+
+    _wait_for_global_slot()
+    return _deliver(fn, args, kwargs, on_sent, on_error)
+
+
+def _outbox_worker():
+    """Deliver queued sends as their chat slots come due, one per chat at a time."""
+    while True:
+        with _outbox_cv:
+            while not _outbox or _outbox[0][0] > time.monotonic():
+                _outbox_cv.wait(_outbox[0][0] - time.monotonic() if _outbox else None)
+            _, _, chat_id = heapq.heappop(_outbox)
+            _, fn, args, kwargs, on_sent, on_error = _outbox_chats[chat_id][0]
+        _wait_for_global_slot()
+        try:
+            _deliver(fn, args, kwargs, on_sent, on_error)
+        except Exception as e:
+            logger.warning("Queued send to chat %s failed: %s", chat_id, e)
+        finally:
+            # Dequeued only now, so a new send can't overtake one in flight
+            with _outbox_cv:
+                pending = _outbox_chats[chat_id]
+                pending.popleft()
+                if pending:
+                    heapq.heappush(_outbox, (pending[0][0], next(_outbox_seq), chat_id))
+                else:
+                    del _outbox_chats[chat_id]
+                _outbox_cv.notify_all()
+
+
+for _ in range(OUTBOX_THREADS):
+    threading.Thread(target=_outbox_worker, name="outbox", daemon=True).start()
+
+
+@atexit.register
+def _drain_outbox():
+    """Give queued sends a short window to go out on shutdown."""
+    deadline = time.monotonic() + OUTBOX_DRAIN_TIMEOUT
+    with _outbox_cv:
+        while _outbox_chats and time.monotonic() < deadline:
+            _outbox_cv.wait(deadline - time.monotonic())
+        if _outbox_chats:
+            logger.warning(
+                "Shutting down with %d queued message(s) unsent",
+                sum(len(p) for p in _outbox_chats.values()),
+            )
+
+
+def _rl_send(chat_id, text, redraw=False, capped=True, on_sent=None, on_error=None, **kwargs):
+    """bot.send_message, paced to stay under Telegram's rate limits (see _rl_call)."""
+    return _rl_call(
+        chat_id, bot.send_message, (chat_id, text), kwargs, redraw, capped, on_sent, on_error
+    )
+
+
+def _rl_edit(
+    chat_id, message_id, text, redraw=False, capped=True, on_sent=None, on_error=None, **kwargs
+):
+    """bot.edit_message_text, paced to stay under Telegram's rate limits (see _rl_call)."""
+    kwargs.update(chat_id=chat_id, message_id=message_id)
+    return _rl_call(
+        chat_id, bot.edit_message_text, (text,), kwargs, redraw, capped, on_sent, on_error
+    )
+
+
+def _rl_reply(message, text, redraw=False, capped=True, on_sent=None, on_error=None, **kwargs):
+    """bot.reply_to, paced like _rl_send."""
+    return _rl_call(
+        message.chat.id, bot.reply_to, (message, text), kwargs, redraw, capped, on_sent, on_error
+    )
+
+
 # ----------------------------------------------------------------------
 # Helper functions: sessions, maintenance, menus, validation
 # ----------------------------------------------------------------------
@@ -170,7 +661,7 @@ def generate_order_id():
 def is_down(chat_id):
     """If maintenance mode is enabled, inform the user and block the action."""
     if MAINTENANCE:
-        bot.send_message(
+        _rl_send(
             chat_id,
             "⚙️ Sorry! The shop is currently *down for maintenance.*\n\n"
             "Please try again soon.",
@@ -189,16 +680,32 @@ def has_active_session(user_id):
 
 
 def update_activity(user_id):
-    """Bump last activity timestamp for timeout tracking."""
-    last_activity[user_id] = datetime.now()
+    """Bump last activity timestamp and evict the least recent users past the cap."""
+    with _session_lock:
+        last_activity[user_id] = time.monotonic()
+        last_activity.move_to_end(user_id)
+        while len(last_activity) > MAX_ACTIVE_SESSIONS:
+            evicted, _ = last_activity.popitem(last=False)
+            evict_session(evicted)
 
 
 def clear_session(user_id):
     """Clear cart and checkout state for the user."""
-    user_carts.pop(user_id, None)
-    user_states.pop(user_id, None)
-    last_activity.pop(user_id, None)
+    with _session_lock:
+        user_carts.pop(user_id, None)
+        user_states.pop(user_id, None)
     # We intentionally do not delete user_cart_message; old messages just become stale.
+    # The user also stays in last_activity, so the sweeper or the LRU cap still
+    # reaches them and evict_session frees those message references later.
+
+
+def evict_session(user_id):
+    """Forget everything held for a user who is no longer being tracked."""
+    with _session_lock:
+        clear_session(user_id)
+        last_activity.pop(user_id, None)
+        user_cart_message.pop(user_id, None)
+        user_menu_messages.pop(user_id, None)
 
 
 def check_and_handle_expiry(user_id, chat_id, is_callback=False, callback_id=None):
@@ -207,17 +714,17 @@ def check_and_handle_expiry(user_id, chat_id, is_callback=False, callback_id=Non
         return False
 
     ts = last_activity.get(user_id)
-    if not ts:
+    if ts is None:
         return False
 
-    if datetime.now() - ts > timedelta(seconds=SESSION_TIMEOUT_SECONDS):
+    if time.monotonic() - ts > SESSION_TIMEOUT_SECONDS:
         clear_session(user_id)
         if is_callback and callback_id:
             try:
                 bot.answer_callback_query(callback_id, "⏰ Session expired.")
             except Exception:
                 pass
-        bot.send_message(
+        _rl_send(
             chat_id,
             "⏰ Your session has expired. Please start again with /order.",
         )
@@ -226,24 +733,102 @@ def check_and_handle_expiry(user_id, chat_id, is_callback=False, callback_id=Non
     return False
 
 
+def sweep_expired_sessions():
+    """Free sessions of users who walked away without coming back."""
+    now = time.monotonic()
+    with _session_lock:
+        # Oldest first, so stop at the first session that is still live
+        while last_activity:
+            user_id, ts = next(iter(last_activity.items()))
+            if now - ts <= SESSION_TIMEOUT_SECONDS:
+                break
+            evict_session(user_id)
+
+
+def _session_sweeper():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            sweep_expired_sessions()
+        except Exception:
+            # Keep sweeping; a dead sweeper would let sessions pile up again
+            logger.exception("Session sweep failed")
+
+
+threading.Thread(target=_session_sweeper, name="session-sweeper", daemon=True).start()
+
+
+# Cosmetic edits of old messages run here, off the handler thread
+_menu_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="menus")
+
+
+def _edit_menus_outdated(entries):
+    for chat_id, msg_id in entries:
+        _rl_edit(
+            chat_id=chat_id,
+            message_id=msg_id,
+            text="❌ This menu is outdated. Please use /order to see the latest stickers.",
+            redraw=True,
+            # Purely cosmetic, and the old menu may already be gone
+            on_error=lambda e: None,
+            parse_mode="Markdown",
+        )
+
+
 def mark_old_menus_outdated(user_id):
-    """Edit previous /order messages for this user and mark them outdated."""
+    """Mark previous /order messages for this user outdated (in the background)."""
     entries = user_menu_messages.get(user_id, [])
     if not entries:
         return
 
-    for chat_id, msg_id in entries:
-        try:
-            bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=msg_id,
-                text="❌ This menu is outdated. Please use /order to see the latest stickers.",
-                parse_mode="Markdown",
-            )
-        except Exception:
-            pass
-
     user_menu_messages[user_id] = []
+    _menu_pool.submit(_edit_menus_outdated, entries)
+
+
+# Everything the cart, review, CSV and admin views need, from one pass
+CartSummary = namedtuple(
+    "CartSummary",
+    "items lines total_items subtotal_pence delivery_pence total_pence",
+)
+
+
+def _finalize_cart(cart):
+    """Price a cart once: per-item text, line totals and order totals in pence."""
+    # Keyed in insertion order, which is also the display order
+    return _price_cart_items(tuple(cart.items()))
+
+
+# The cart, review, CSV and admin views re-price the same unchanged cart
+@functools.lru_cache(maxsize=4096)
+def _price_cart_items(cart_items):
+    items = []
+    lines = []
+    total_items = 0
+    subtotal_pence = 0
+
+    for item, qty in cart_items:
+        price_pence = _PRICE_PENCE.get(item)
+        if price_pence is None:
+            continue
+        line_pence = price_pence * qty
+        items.append(f"{qty}x {item}")
+        lines.append(f"{qty}x {_EMOJI[item]} {item} — {SYMBOL}{line_pence / 100:.2f}")
+        total_items += qty
+        subtotal_pence += line_pence
+
+    if subtotal_pence >= FREE_DELIVERY_THRESHOLD_PENCE:
+        delivery_pence = 0
+    else:
+        delivery_pence = DELIVERY_FEE_PENCE
+
+    return CartSummary(
+        tuple(items),
+        tuple(lines),
+        total_items,
+        subtotal_pence,
+        delivery_pence,
+        subtotal_pence + delivery_pence,
+    )
 
 
 def build_cart_text(user_id):
@@ -252,34 +837,20 @@ def build_cart_text(user_id):
     if not cart:
         return ("🛒 Your cart is empty. Use /order to add stickers.", False)
 
-    text = "🛒 *Your Cart:*\n\n"
-    total_items = 0
-    subtotal = Decimal("0.00")
-
-    for item, qty in cart.items():
-        if item not in catalog:
-            continue
-        price = catalog[item]["price"]
-        line_total = (price * qty).quantize(Decimal("0.01"), ROUND_HALF_UP)
-        text += f"{qty}x {catalog[item]['emoji']} {item} — {SYMBOL}{line_total:.2f}\n"
-        total_items += qty
-        subtotal += line_total
+    priced = _finalize_cart(cart)
 
     # Delivery logic
-    if subtotal >= FREE_DELIVERY_THRESHOLD:
-        delivery = Decimal("0.00")
+    if priced.subtotal_pence >= FREE_DELIVERY_THRESHOLD_PENCE:
         delivery_line = f"🚚 *Free delivery!* (orders over {SYMBOL}{FREE_DELIVERY_THRESHOLD:.2f})"
     else:
-        delivery = DELIVERY_FEE
         delivery_line = f"🚚 Delivery fee: {SYMBOL}{DELIVERY_FEE:.2f}"
 
-    total = (subtotal + delivery).quantize(Decimal("0.01"), ROUND_HALF_UP)
-
-    text += (
-        f"\nTotal items: {total_items}\n"
-        f"Subtotal: {SYMBOL}{subtotal:.2f}\n"
+    text = (
+        "🛒 *Your Cart:*\n\n" + "\n".join(priced.lines) +
+        f"\n\nTotal items: {priced.total_items}\n"
+        f"Subtotal: {SYMBOL}{priced.subtotal_pence / 100:.2f}\n"
         f"{delivery_line}\n"
-        f"💰 *Total: {SYMBOL}{total:.2f}*"
+        f"💰 *Total: {SYMBOL}{priced.total_pence / 100:.2f}*"
     )
 
     return (text, True)
@@ -287,47 +858,131 @@ def build_cart_text(user_id):
 
 def refresh_cart_message(user_id, chat_id):
     """Create or update the single cart message with inline controls."""
+    # This refresh shows the latest cart, so a debounced one still pending
+    # would only re-send it
+    with _pending_refresh_lock:
+        timer = _pending_refresh.pop(user_id, None)
+    if timer:
+        timer.cancel()
+
+    _render_cart_message(user_id, chat_id)
+
+
+def _render_cart_message(user_id, chat_id):
     text, has_items = build_cart_text(user_id)
 
-    kb = InlineKeyboardMarkup()
-    if has_items:
-        kb.add(
-            InlineKeyboardButton("✅ Checkout", callback_data="begin_checkout"),
-            InlineKeyboardButton("🛍 Continue Shopping", callback_data="continue_order"),
-            InlineKeyboardButton("🗑 Clear Cart", callback_data="clear_cart"),
+    kb = _CART_KB_ITEMS if has_items else _CART_KB_EMPTY
+
+    with _session_lock:
+        existing = user_cart_message.get(user_id)
+        if existing and existing[1] is None:
+            # A new cart message is still queued; note the latest text and let
+            # it catch up once it goes out instead of posting a second cart
+            user_cart_message[user_id] = (existing[0], None, text)
+            return
+        if not existing or existing[2] == text:
+            # Pending marker (no message id yet) for refreshes until then
+            user_cart_message[user_id] = (chat_id, None, text)
+
+    # Recorded once the edit or send actually goes out (maybe from the outbox)
+    remember = functools.partial(_remember_cart_message, user_id, text)
+
+    # An identical edit is always rejected ("message is not modified"), so
+    # skip that round-trip and go straight to re-sending the cart below
+    if existing and existing[2] != text:
+        e_chat_id, e_msg_id, _ = existing
+        _rl_edit(
+            chat_id=e_chat_id,
+            message_id=e_msg_id,
+            text=text,
+            redraw=True,
+            on_sent=remember,
+            on_error=functools.partial(_cart_edit_failed, user_id, chat_id, e_msg_id),
+            parse_mode="Markdown",
+            reply_markup=kb,
         )
-    else:
-        kb.add(InlineKeyboardButton("🛍 Continue Shopping", callback_data="continue_order"))
+        # Skipped (chat over its rate): the next cart action redraws it
+        return
 
-    existing = user_cart_message.get(user_id)
+    _rl_send(
+        chat_id,
+        text,
+        on_sent=remember,
+        on_error=functools.partial(_cart_send_failed, user_id),
+        parse_mode="Markdown",
+        reply_markup=kb,
+    )
 
-    if existing:
-        e_chat_id, e_msg_id = existing
-        try:
-            bot.edit_message_text(
-                chat_id=e_chat_id,
-                message_id=e_msg_id,
-                text=text,
-                parse_mode="Markdown",
-                reply_markup=kb,
-            )
+
+def _remember_cart_message(user_id, text, msg):
+    with _session_lock:
+        # A send delivered late from the outbox mustn't revive an evicted user
+        if user_id not in last_activity:
             return
-        except Exception:
-            pass  # fall through and send new
+        existing = user_cart_message.get(user_id)
+        user_cart_message[user_id] = (msg.chat.id, msg.message_id, text)
+        # Refreshes coalesced onto the queued send may have changed the cart
+        stale = existing and existing[1] is None and existing[2] != text
+    if stale:
+        run_for_user(user_id, refresh_cart_message, user_id, msg.chat.id)
+
+
+def _cart_send_failed(user_id, exc):
+    """on_error for a new cart message: drop its pending marker."""
+    logger.warning("Cart message for user %s not sent: %s", user_id, exc)
+    with _session_lock:
+        existing = user_cart_message.get(user_id)
+        if existing and existing[1] is None:
+            del user_cart_message[user_id]
+
+
+def _cart_edit_failed(user_id, chat_id, msg_id, exc):
+    """on_error for a cart edit, sent now or from the outbox: post a fresh cart."""
+    if not isinstance(exc, ApiTelegramException):
+        logger.warning("Cart edit for user %s failed: %s", user_id, exc)
+        return
+    # Message deleted / too old to edit: forget it, so the redraw sends anew
+    with _session_lock:
+        existing = user_cart_message.get(user_id)
+        if existing and existing[1] == msg_id:
+            del user_cart_message[user_id]
+    run_for_user(user_id, refresh_cart_message, user_id, chat_id)
+
+
+# Delay that lets a burst of add taps collapse into one cart edit
+CART_REFRESH_DELAY = 0.25  # seconds
+
+# user_id -> pending cart refresh timer
+_pending_refresh = {}
+_pending_refresh_lock = threading.Lock()
 
-    msg = bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
-    user_cart_message[user_id] = (chat_id, msg.message_id)
+
+def schedule_cart_refresh(user_id, chat_id):
+    """Refresh the cart message once taps stop for CART_REFRESH_DELAY."""
+    with _pending_refresh_lock:
+        timer = _pending_refresh.pop(user_id, None)
+        if timer:
+            timer.cancel()
+        timer = threading.Timer(CART_REFRESH_DELAY, _run_cart_refresh, args=(user_id, chat_id))
+        timer.daemon = True
+        _pending_refresh[user_id] = timer
+    timer.start()
+
+
+def _run_cart_refresh(user_id, chat_id):
+    with _pending_refresh_lock:
+        if _pending_refresh.get(user_id) is not threading.current_thread():
+            return  # superseded by a later tap or an immediate refresh
+        del _pending_refresh[user_id]
+    # In turn with the user's handlers, so it never races a cart change
+    run_for_user(user_id, refresh_cart_message, user_id, chat_id)
 
 
 def prompt_next_field(chat_id, field, step):
     """Prompt user for the given delivery field."""
-    kb = InlineKeyboardMarkup()
-    if step == 0:
-        kb.add(InlineKeyboardButton("🛍 Continue Shopping", callback_data="continue_order"))
-    else:
-        kb.add(InlineKeyboardButton("↩️ /back", callback_data="back"))
+    kb = _CONTINUE_KB if step == 0 else _BACK_KB
 
-    bot.send_message(
+    _rl_send(
         chat_id,
         delivery_prompts[field],
         parse_mode="Markdown",
@@ -335,21 +990,68 @@ def prompt_next_field(chat_id, field, step):
     )
 
 
+# Longest input accepted for any checkout field (cheap reject before regex)
+FIELD_MAX_LENGTH = 60
+
+# Compiled once; ASCII-only classes skip the Unicode tables
+_FIELD_RE = {
+    "name": re.compile(r"^[A-Za-z\s]{3,}$", re.ASCII),
+    "house": re.compile(r"^[A-Za-z0-9\s\-]{1,10}$", re.ASCII),
+    # UK-style; adjust if needed
+    "postcode": re.compile(r"^[A-Z]{1,2}[0-9][0-9A-Z]?\s?[0-9][A-Z]{2}$", re.ASCII | re.IGNORECASE),
+}
+
+
+# Rule per checkout field, keyed like delivery_steps / delivery_prompts;
+# a field without an entry accepts any text
+_FIELD_CHECKS = {
+    "name": lambda t: bool(_FIELD_RE["name"].match(t)) and " " in t,
+    "house": _FIELD_RE["house"].match,
+    "street": lambda t: len(t) >= 3 and any(c.isalpha() for c in t),
+    "city": lambda t: len(t) >= 2 and any(c.isalpha() for c in t),
+    "postcode": _FIELD_RE["postcode"].match,
+}
+
+
 def validate_field(field, text):
     """Basic validation rules for checkout fields."""
     t = text.strip()
-    if field == "name":
-        return bool(re.match(r"^[A-Za-z\s]{3,}$", t)) and " " in t
-    if field == "house":
-        return bool(re.match(r"^[A-Za-z0-9\s\-]{1,10}$", t))
-    if field == "street":
-        return len(t) >= 3 and any(c.isalpha() for c in t)
-    if field == "city":
-        return len(t) >= 2 and any(c.isalpha() for c in t)
-    if field == "postcode":
-        # UK-style; adjust if needed
-        return bool(re.match(r"^[A-Z]{1,2}[0-9][0-9A-Z]?\s?[0-9][A-Z]{2}$", t.upper()))
-    return True
+    if len(t) > FIELD_MAX_LENGTH:
+        return False
+    check = _FIELD_CHECKS.get(field)
+    return check is None or bool(check(t))
+
+
+# Characters that open an entity in legacy Markdown parse mode
+_MD_SPECIAL_RE = re.compile(r"([_*`\[])")
+
+
+def escape_md(text):
+    """Escape user-supplied text for a parse_mode="Markdown" message."""
+    return _MD_SPECIAL_RE.sub(r"\\\1", str(text))
+
+
+# Message templates, filled with str.format_map / str.format in one pass
+_ADDR_TPL = "{name}\n{house} {street}\n{city} {postcode}"
+
+
+def format_address(info):
+    """Render the delivery address block, Markdown-escaped."""
+    return _ADDR_TPL.format_map({k: escape_md(v) for k, v in info.items()})
+
+
+_ADMIN_ORDER_TPL = (
+    "📦 *New order received!*\n"
+    "🆔 Order ID: *{order_id}*\n"
+    "👤 Telegram: @{telegram}\n\n"
+    "{stickers}\n\n"
+    "Subtotal: " + SYMBOL + "{subtotal:.2f}\n"
+    "{delivery}\n"
+    "💰 Total: *" + SYMBOL + "{total:.2f}*\n\n"
+    "📍 Address:\n"
+    "{address}\n\n"
+    "Status: _pending_"
+)
 
 
 def send_order_review(chat_id, user_id):
@@ -358,105 +1060,176 @@ def send_order_review(chat_id, user_id):
     cart = user_carts.get(user_id, {})
 
     if not cart:
-        bot.send_message(chat_id, "🛒 Your cart is empty. Please /order again.")
+        _rl_send(chat_id, "🛒 Your cart is empty. Please /order again.")
         clear_session(user_id)
         return
 
-    lines = []
-    subtotal = Decimal("0.00")
+    priced = _finalize_cart(cart)
 
-    for item, qty in cart.items():
-        if item not in catalog:
-            continue
-        price = catalog[item]["price"]
-        line_total = (price * qty).quantize(Decimal("0.01"), ROUND_HALF_UP)
-        subtotal += line_total
-        lines.append(f"{qty}x {catalog[item]['emoji']} {item} — {SYMBOL}{line_total:.2f}")
-
-    if subtotal >= FREE_DELIVERY_THRESHOLD:
-        delivery = Decimal("0.00")
+    if priced.subtotal_pence >= FREE_DELIVERY_THRESHOLD_PENCE:
         delivery_line = "🚚 *Free delivery applied!* 🎉"
     else:
-        delivery = DELIVERY_FEE
         delivery_line = f"🚚 Delivery: {SYMBOL}{DELIVERY_FEE:.2f}"
 
-    total = (subtotal + delivery).quantize(Decimal("0.01"), ROUND_HALF_UP)
-
     summary = (
         "✅ *Confirm your order:*\n\n"
-        "🛍 *Stickers:*\n" + "\n".join(lines) +
-        f"\n\nSubtotal: {SYMBOL}{subtotal:.2f}\n"
+        "🛍 *Stickers:*\n" + "\n".join(priced.lines) +
+        f"\n\nSubtotal: {SYMBOL}{priced.subtotal_pence / 100:.2f}\n"
         f"{delivery_line}\n"
-        f"💰 *Total: {SYMBOL}{total:.2f}*\n\n"
-        "📍 *Delivery Address:*\n"
-        f"{info['name']}\n"
-        f"{info['house']} {info['street']}\n"
-        f"{info['city']} {info['postcode']}"
+        f"💰 *Total: {SYMBOL}{priced.total_pence / 100:.2f}*\n\n"
+        "📍 *Delivery Address:*\n" + format_address(info)
     )
 
-    kb = InlineKeyboardMarkup()
-    kb.add(
-        InlineKeyboardButton("✅ Confirm", callback_data="confirm_details"),
-        InlineKeyboardButton("✏️ Edit Address", callback_data="edit_address"),
-        InlineKeyboardButton("↩️ /back", callback_data="back"),
-    )
+    _rl_send(chat_id, summary, parse_mode="Markdown", reply_markup=_REVIEW_KB)
 
-    bot.send_message(chat_id, summary, parse_mode="Markdown", reply_markup=kb)
 
-
-def notify_admins(order_id, user, cart, info, subtotal, delivery, total):
-    """Notify admins (and optional channel) of a new order."""
-    lines = []
-    for item, qty in cart.items():
-        if item not in catalog:
-            continue
-        price = catalog[item]["price"]
-        line_total = (price * qty).quantize(Decimal("0.01"), ROUND_HALF_UP)
-        lines.append(f"{qty}x {catalog[item]['emoji']} {item} — {SYMBOL}{line_total:.2f}")
-    stickers_block = "\n".join(lines)
-
-    if delivery == 0:
+def notify_admins(order_id, user, priced, info):
+    """Notify admins (and optional channel) of a new order priced by _finalize_cart."""
+    if priced.delivery_pence == 0:
         delivery_text = "🚚 Free delivery"
     else:
-        delivery_text = f"🚚 Delivery: {SYMBOL}{delivery:.2f}"
-
-    text = (
-        f"📦 *New order received!*\n"
-        f"🆔 Order ID: *{order_id}*\n"
-        f"👤 Telegram: @{user.username or user.first_name}\n\n"
-        f"{stickers_block}\n\n"
-        f"Subtotal: {SYMBOL}{subtotal:.2f}\n"
-        f"{delivery_text}\n"
-        f"💰 Total: *{SYMBOL}{total:.2f}*\n\n"
-        "📍 Address:\n"
-        f"{info['name']}\n"
-        f"{info['house']} {info['street']}\n"
-        f"{info['city']} {info['postcode']}\n\n"
-        "Status: _pending_"
+        delivery_text = f"🚚 Delivery: {SYMBOL}{priced.delivery_pence / 100:.2f}"
+
+    text = _ADMIN_ORDER_TPL.format(
+        order_id=order_id,
+        telegram=escape_md(user.username or user.first_name),
+        stickers="\n".join(priced.lines),
+        subtotal=priced.subtotal_pence / 100,
+        delivery=delivery_text,
+        total=priced.total_pence / 100,
+        address=format_address(info),
     )
 
-    for admin_id in ADMIN_IDS:
-        try:
-            bot.send_message(admin_id, text, parse_mode="Markdown")
-        except Exception:
-            pass
-
+    recipients = list(ADMIN_IDS)
     if NOTIFY_CHANNEL_ID:
-        try:
-            bot.send_message(NOTIFY_CHANNEL_ID, text, parse_mode="Markdown")
-        except Exception:
-            pass
+        recipients.append(NOTIFY_CHANNEL_ID)
+
+    # Sent by _notify_worker so the confirming user isn't kept waiting
+    try:
+        _notify_queue.put_nowait((recipients, text))
+    except queue.Full:
+        # Never park the confirming handler; log the whole order instead so
+        # it can still be picked up from the logs
+        logger.error("Admin notification queue full; order %s not sent:\n%s", order_id, text)
+
+
+# Pending admin notifications: (recipient_ids, text); bounded so a stalled
+# Telegram API can't grow memory without limit (overflow is logged)
+_notify_queue = queue.Queue(maxsize=500)
+# Fans one notification out to every recipient at once
+_notify_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="notify-send")
+
+
+def _notify_worker():
+    """Deliver queued admin/channel notifications in the background."""
+    while True:
+        item = _notify_queue.get()
+        if item is None:
+            break
+        recipients, text = item
+        futures = []
+        for chat_id in recipients:
+            try:
+                futures.append(_notify_pool.submit(_send_notification, chat_id, text))
+            except RuntimeError:
+                # The pool takes no new work once the interpreter is shutting
+                # down, which is when atexit drains this queue; send from here
+                _send_notification(chat_id, text)
+        # Wait for the whole batch so each recipient still sees orders in sequence
+        for future in futures:
+            future.result()
+        _notify_queue.task_done()
+
+
+def _send_notification(chat_id, text):
+    try:
+        # Exempt from the outbox cap: an order must always reach the admins
+        _rl_send(chat_id, text, capped=False, parse_mode="Markdown")
+    except Exception as e:
+        logger.warning("Admin notification to %s failed: %s", chat_id, e)
+
+
+_notify_thread = threading.Thread(target=_notify_worker, name="notify", daemon=True)
+_notify_thread.start()
+NOTIFY_DRAIN_TIMEOUT = 2.0  # seconds allowed at shutdown for queued notifications
+
+
+@atexit.register
+def _drain_notifications():
+    """Hand queued admin notifications to the sender before shutting down."""
+    deadline = time.monotonic() + NOTIFY_DRAIN_TIMEOUT
+    try:
+        # None tells the worker to stop once everything ahead of it is sent
+        _notify_queue.put(None, timeout=NOTIFY_DRAIN_TIMEOUT)
+    except queue.Full:
+        pass
+    _notify_thread.join(timeout=max(0.0, deadline - time.monotonic()))
+    if _notify_thread.is_alive():
+        logger.warning(
+            "Shutting down with about %d admin notification(s) unsent", _notify_queue.qsize()
+        )
 
 
 def is_admin(user_id):
     return user_id in ADMIN_IDS
 
 
+# ----------------------------------------------------------------------
+# Per-user dispatch: one user's updates run one at a time, in order
+# ----------------------------------------------------------------------
+
+# user_id -> deque of (fn, args) to run for that user, oldest first; the head
+# is running, on whichever thread queued it into an empty deque
+_user_tasks = {}
+_user_tasks_lock = threading.Lock()
+# .busy is set while this thread runs a user's tasks
+_dispatch_state = threading.local()
+
+
+def run_for_user(user_id, fn, *args):
+    """Run fn(*args) after the user's earlier tasks, never two at once per user."""
+    if getattr(_dispatch_state, "busy", False):
+        # Called from inside a task (e.g. one handler delegating to another)
+        fn(*args)
+        return
+    with _user_tasks_lock:
+        tasks = _user_tasks.get(user_id)
+        if tasks is not None:
+            # The thread running this user's tasks gets to it in turn
+            tasks.append((fn, args))
+            return
+        tasks = _user_tasks[user_id] = deque([(fn, args)])
+    _dispatch_state.busy = True
+    try:
+        while True:
+            fn, args = tasks[0]
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("%s for user %s failed", fn.__name__, user_id)
+            with _user_tasks_lock:
+                tasks.popleft()
+                if not tasks:
+                    del _user_tasks[user_id]
+                    return
+    finally:
+        _dispatch_state.busy = False
+
+
+def per_user(handler):
+    """Handler decorator: queue each update behind the same user's earlier ones."""
+    @functools.wraps(handler)
+    def wrapper(update):
+        run_for_user(update.from_user.id, handler, update)
+    return wrapper
+
+
 # ----------------------------------------------------------------------
 # Core commands: /start, /restart, /help
 # ----------------------------------------------------------------------
 
 @bot.message_handler(commands=["start"])
+@per_user
 def start(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -466,7 +1239,7 @@ def start(message):
 
     update_activity(user_id)
 
-    bot.send_message(
+    _rl_send(
         chat_id,
         f"👋 Welcome to *{SHOP_NAME}!*\n\n"
         f"🚚 Delivery is {SYMBOL}{DELIVERY_FEE:.2f}, "
@@ -478,6 +1251,7 @@ def start(message):
 
 
 @bot.message_handler(commands=["restart"])
+@per_user
 def restart(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -486,12 +1260,13 @@ def restart(message):
         return
 
     clear_session(user_id)
-    bot.send_message(chat_id, "🔄 Session reset. Use /order to start again.")
+    _rl_send(chat_id, "🔄 Session reset. Use /order to start again.")
 
 
 @bot.message_handler(commands=["help"])
+@per_user
 def help_cmd(message):
-    bot.reply_to(
+    _rl_reply(
         message,
         "🛒 *Commands:*\n"
         "/order – browse stickers\n"
@@ -507,6 +1282,7 @@ def help_cmd(message):
 # ----------------------------------------------------------------------
 
 @bot.message_handler(commands=["order"])
+@per_user
 def order(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -519,30 +1295,26 @@ def order(message):
     mark_old_menus_outdated(user_id)
     user_menu_messages[user_id] = []
 
+    remember = functools.partial(_remember_menu_message, user_id)
+
     if not catalog:
-        msg = bot.send_message(chat_id, "⚠️ No products are available right now.")
-        user_menu_messages[user_id].append((chat_id, msg.message_id))
+        _rl_send(chat_id, "⚠️ No products are available right now.", on_sent=remember)
         return
 
-    text = "🛍 *Our Stickers:*\n\n"
-    for name, data in catalog.items():
-        text += f"{data['emoji']} {name} — {SYMBOL}{data['price']:.2f}\n"
-
-    text += (
-        f"\n🚚 Delivery: {SYMBOL}{DELIVERY_FEE:.2f} "
-        f"(free over {SYMBOL}{FREE_DELIVERY_THRESHOLD:.2f})\n"
-        "Tap a button below to add to your cart 👇"
+    _rl_send(
+        chat_id,
+        _ORDER_MENU_TEXT,
+        on_sent=remember,
+        parse_mode="Markdown",
+        reply_markup=_ORDER_KB_JSON,
     )
 
-    kb = InlineKeyboardMarkup(row_width=2)
-    for name, data in catalog.items():
-        kb.add(InlineKeyboardButton(f"{data['emoji']} {name}", callback_data=f"add|{name}"))
-
-    # Persistent Open Cart button (replaces Checkout in catalog view)
-    kb.add(InlineKeyboardButton("🛒 Open Cart", callback_data="open_cart"))
 
-    msg = bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
-    user_menu_messages[user_id].append((chat_id, msg.message_id))
+def _remember_menu_message(user_id, msg):
+    with _session_lock:
+        # A send delivered late from the outbox mustn't revive an evicted user
+        if user_id in last_activity:
+            user_menu_messages.setdefault(user_id, []).append((msg.chat.id, msg.message_id))
 
 
 # ----------------------------------------------------------------------
@@ -550,6 +1322,7 @@ def order(message):
 # ----------------------------------------------------------------------
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("add|"))
+@per_user
 def add_to_cart(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -563,26 +1336,32 @@ def add_to_cart(callback):
         bot.answer_callback_query(callback.id, "⚠️ Item no longer available.")
         return
 
+    # Acknowledge first so the client spinner clears before any API work
+    bot.answer_callback_query(callback.id, f"🛒 Added {item}!")
+
     update_activity(user_id)
 
     user_carts.setdefault(user_id, {})
     user_carts[user_id][item] = user_carts[user_id].get(item, 0) + 1
 
-    bot.answer_callback_query(callback.id, f"🛒 Added {item}!")
-
-    # Always show or refresh cart (auto open on first add)
-    refresh_cart_message(user_id, chat_id)
+    # Always show or refresh cart (auto open on first add); rapid taps are
+    # coalesced into a single edit
+    schedule_cart_refresh(user_id, chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data == "open_cart")
+@per_user
 def open_cart_callback(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
     bot.answer_callback_query(callback.id)
+    # Index the user so the cart message reference below is freed with them
+    update_activity(user_id)
     refresh_cart_message(user_id, chat_id)
 
 
 @bot.message_handler(commands=["cart"])
+@per_user
 def show_cart(message):
     chat_id = message.chat.id
     user_id = message.from_user.id
@@ -598,6 +1377,7 @@ def show_cart(message):
 
 
 @bot.callback_query_handler(func=lambda c: c.data == "clear_cart")
+@per_user
 def clear_cart(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -605,14 +1385,15 @@ def clear_cart(callback):
     if check_and_handle_expiry(user_id, chat_id, is_callback=True, callback_id=callback.id):
         return
 
+    bot.answer_callback_query(callback.id, "🗑 Cart cleared!")
     update_activity(user_id)
 
     user_carts[user_id] = {}
-    bot.answer_callback_query(callback.id, "🗑 Cart cleared!")
     refresh_cart_message(user_id, chat_id)
 
 
 @bot.callback_query_handler(func=lambda c: c.data in ["continue_order", "begin_checkout"])
+@per_user
 def handle_cart_actions(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -620,46 +1401,36 @@ def handle_cart_actions(callback):
     if check_and_handle_expiry(user_id, chat_id, is_callback=True, callback_id=callback.id):
         return
 
+    bot.answer_callback_query(callback.id)
     update_activity(user_id)
 
     if callback.data == "continue_order":
-        bot.answer_callback_query(callback.id)
         order(callback.message)
 
     elif callback.data == "begin_checkout":
-        bot.answer_callback_query(callback.id)
         begin_checkout(callback)
 
 
 def begin_checkout(callback):
+    """Start the delivery-details flow (callback already answered and expiry checked)."""
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
 
     cart = user_carts.get(user_id, {})
     if not cart:
-        bot.send_message(chat_id, "🛍 Your cart is empty! Add stickers first with /order.")
-        return
-
-    if check_and_handle_expiry(user_id, chat_id, is_callback=True, callback_id=callback.id):
+        _rl_send(chat_id, "🛍 Your cart is empty! Add stickers first with /order.")
         return
 
-    update_activity(user_id)
-
     user_states[user_id] = {"step": 0, "data": {}}
 
-    subtotal = sum(
-        (catalog[item]["price"] * qty for item, qty in cart.items() if item in catalog),
-        Decimal("0.00"),
-    ).quantize(Decimal("0.01"), ROUND_HALF_UP)
+    priced = _finalize_cart(cart)
+    summary = "\n".join(priced.items)
 
-    lines = [f"{qty}x {item}" for item, qty in cart.items() if item in catalog]
-    summary = "\n".join(lines)
-
-    bot.send_message(
+    _rl_send(
         chat_id,
         f"🧾 *Your Order Summary:*\n\n"
         f"{summary}\n\n"
-        f"Current subtotal: {SYMBOL}{subtotal:.2f}\n"
+        f"Current subtotal: {SYMBOL}{priced.subtotal_pence / 100:.2f}\n"
         f"🚚 Delivery: {SYMBOL}{DELIVERY_FEE:.2f} "
         f"(free over {SYMBOL}{FREE_DELIVERY_THRESHOLD:.2f})\n\n"
         "Now let's collect your delivery details.",
@@ -674,6 +1445,7 @@ def begin_checkout(callback):
 # ----------------------------------------------------------------------
 
 @bot.callback_query_handler(func=lambda c: c.data == "back")
+@per_user
 def go_back(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -691,7 +1463,7 @@ def go_back(callback):
         user_states[user_id]["step"] -= 1
         prev_field = delivery_steps[user_states[user_id]["step"]]
         bot.answer_callback_query(callback.id)
-        bot.send_message(chat_id, "↩️ Going back.", parse_mode="Markdown")
+        _rl_send(chat_id, "↩️ Going back.", parse_mode="Markdown")
         prompt_next_field(chat_id, prev_field, user_states[user_id]["step"])
         update_activity(user_id)
     else:
@@ -699,6 +1471,7 @@ def go_back(callback):
 
 
 @bot.callback_query_handler(func=lambda c: c.data == "edit_address")
+@per_user
 def edit_address(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -710,8 +1483,8 @@ def edit_address(callback):
         bot.answer_callback_query(callback.id, "No address to edit.")
         return
 
-    user_states[user_id]["step"] = 0
     bot.answer_callback_query(callback.id, "✏️ Let's edit your address.")
+    user_states[user_id]["step"] = 0
     prompt_next_field(chat_id, "name", step=0)
 
 
@@ -719,63 +1492,111 @@ def edit_address(callback):
 # Text input handler during checkout
 # ----------------------------------------------------------------------
 
-@bot.message_handler(func=lambda m: True)
+def _is_checkout(message):
+    return message.from_user.id in user_states
+
+
+@bot.message_handler(content_types=["text"], func=_is_checkout)
+@per_user
 def handle_checkout_input(message):
     user_id = message.from_user.id
     chat_id = message.chat.id
     text = message.text.strip()
 
-    if user_id in user_states:
-        if check_and_handle_expiry(user_id, chat_id):
-            return
-
-        step = user_states[user_id]["step"]
-        if step >= len(delivery_steps):
-            return
+    if check_and_handle_expiry(user_id, chat_id):
+        return
 
-        field = delivery_steps[step]
+    step = user_states[user_id]["step"]
+    if step >= len(delivery_steps):
+        return
 
-        if not validate_field(field, text):
-            bot.send_message(
-                chat_id,
-                f"⚠️ That doesn’t look like a valid {field}. Please try again.",
-            )
-            prompt_next_field(chat_id, field, step)
-            return
+    field = delivery_steps[step]
 
-        user_states[user_id]["data"][field] = text
-        user_states[user_id]["step"] += 1
-        update_activity(user_id)
+    if not validate_field(field, text):
+        _rl_send(
+            chat_id,
+            f"⚠️ That doesn’t look like a valid {field}. Please try again.",
+        )
+        prompt_next_field(chat_id, field, step)
+        return
 
-        if user_states[user_id]["step"] >= len(delivery_steps):
-            send_order_review(chat_id, user_id)
-            return
+    user_states[user_id]["data"][field] = text
+    user_states[user_id]["step"] += 1
+    update_activity(user_id)
 
-        next_field = delivery_steps[user_states[user_id]["step"]]
-        prompt_next_field(chat_id, next_field, user_states[user_id]["step"])
+    if user_states[user_id]["step"] >= len(delivery_steps):
+        send_order_review(chat_id, user_id)
         return
 
-    # Not in checkout: respond helpfully
-    if text.startswith("/"):
-        bot.send_message(
-            chat_id,
-            "❓ Unknown command.\n"
-            "Use /order to browse, /cart to view your cart, or /restart to reset.",
-        )
-    else:
-        bot.send_message(
-            chat_id,
-            "🛍 To start shopping, use /order.\n"
-            "To see your cart, use /cart.\n"
-            "If something feels stuck, use /restart.",
-        )
+    next_field = delivery_steps[user_states[user_id]["step"]]
+    prompt_next_field(chat_id, next_field, user_states[user_id]["step"])
 
 
 # ----------------------------------------------------------------------
 # Confirm Order → CSV + Stripe Checkout + Admin notify
 # ----------------------------------------------------------------------
 
+# Stripe Checkout Sessions are created off the handler thread
+_stripe_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="stripe")
+
+
+def _create_checkout_session(order_id, total_pence, username):
+    """Create a Stripe Checkout Session for the whole order total."""
+    return _stripe().checkout.Session.create(
+        mode="payment",
+        payment_method_types=["card"],
+        line_items=[
+            {
+                "price_data": {
+                    "currency": CURRENCY.lower(),
+                    "product_data": {
+                        "name": f"{SHOP_NAME} Order {order_id}",
+                    },
+                    "unit_amount": total_pence,
+                },
+                "quantity": 1,
+            }
+        ],
+        success_url=f"{SUCCESS_URL}?order_id={order_id}",
+        cancel_url=f"{CANCEL_URL}?order_id={order_id}",
+        metadata={
+            "order_id": order_id,
+            "telegram_user": username,
+        },
+    )
+
+
+def _send_pay_button(chat_id, order_id, total_pence, future):
+    """Done-callback for _create_checkout_session: send Pay Now or the fallback."""
+    try:
+        checkout_session = future.result()
+    except Exception as e:
+        # Fallback to manual payment if Stripe fails
+        _rl_send(
+            chat_id,
+            "✅ Your order has been saved, but payment setup failed.\n"
+            "We'll contact you soon to arrange payment manually.\n"
+            f"Error: {escape_md(e)}",
+            parse_mode="Markdown",
+        )
+        return
+
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("💳 Pay Now", url=checkout_session.url))
+    kb.add(_ANOTHER_ORDER_BUTTON)
+
+    _rl_send(
+        chat_id,
+        f"✅ Order *{order_id}* saved.\n"
+        f"💰 Total: {SYMBOL}{total_pence / 100:.2f}\n"
+        "Tap below to complete your payment securely:",
+        parse_mode="Markdown",
+        reply_markup=kb,
+    )
+
+
 @bot.callback_query_handler(func=lambda c: c.data == "confirm_details")
+@per_user
 def confirm_order(callback):
     user_id = callback.from_user.id
     chat_id = callback.message.chat.id
@@ -792,112 +1613,61 @@ def confirm_order(callback):
 
     if not cart:
         bot.answer_callback_query(callback.id, "Cart is empty.")
-        bot.send_message(chat_id, "🛒 Your cart is empty. Please /order again.")
+        _rl_send(chat_id, "🛒 Your cart is empty. Please /order again.")
         clear_session(user_id)
         return
 
-    subtotal = sum(
-        (catalog[item]["price"] * qty for item, qty in cart.items() if item in catalog),
-        Decimal("0.00"),
-    ).quantize(Decimal("0.01"), ROUND_HALF_UP)
-
-    if subtotal >= FREE_DELIVERY_THRESHOLD:
-        delivery = Decimal("0.00")
-    else:
-        delivery = DELIVERY_FEE
-
-    total = (subtotal + delivery).quantize(Decimal("0.01"), ROUND_HALF_UP)
+    # One pricing pass shared by Stripe, the CSV row and the admin message;
+    # integer pence throughout, converted to pounds only for display
+    priced = _finalize_cart(cart)
+    total_pence = priced.total_pence
 
     order_id = generate_order_id()
-    cart_summary = ", ".join(
-        [f"{qty}x {item}" for item, qty in cart.items() if item in catalog]
-    )
-
-    # Save order as pending in CSV
-    with open(csv_filename, "a", newline="", encoding="utf-8") as f:
-        writer = csv.writer(f)
-        writer.writerow([
-            order_id,
-            callback.from_user.username or callback.from_user.first_name,
-            cart_summary,
-            info["name"],
-            info["house"],
-            info["street"],
-            info["city"],
-            info["postcode"],
-            "pending",
-            datetime.now().strftime("%Y-%m-%d %H:%M"),
-            f"{total:.2f}",
-            CURRENCY,
-        ])
 
+    # Acknowledge once the order has its number (fast local I/O), but before
+    # the CSV write, admin fan-out and Stripe round-trip, which together can
+    # exceed Telegram's callback window
     bot.answer_callback_query(callback.id, "✅ Order saved!")
 
-    # Notify admins about new order
-    notify_admins(order_id, callback.from_user, cart, info, subtotal, delivery, total)
-
-    # If Stripe configured → create Checkout Session
-    if stripe.api_key:
-        try:
-            checkout_session = stripe.checkout.Session.create(
-                mode="payment",
-                payment_method_types=["card"],
-                line_items=[
-                    {
-                        "price_data": {
-                            "currency": CURRENCY.lower(),
-                            "product_data": {
-                                "name": f"{SHOP_NAME} Order {order_id}",
-                            },
-                            "unit_amount": int(total * 100),
-                        },
-                        "quantity": 1,
-                    }
-                ],
-                success_url=f"{SUCCESS_URL}?order_id={order_id}",
-                cancel_url=f"{CANCEL_URL}?order_id={order_id}",
-                metadata={
-                    "order_id": order_id,
-                    "telegram_user": callback.from_user.username or "",
-                },
-            )
-
-            pay_url = checkout_session.url
+    # If Stripe configured → create the Checkout Session in the background;
+    # the Pay Now button is sent when it resolves, overlapping the CSV write
+    # and admin notification below
+    if STRIPE_SECRET_KEY:
+        future = _stripe_pool.submit(
+            _create_checkout_session, order_id, total_pence, callback.from_user.username or ""
+        )
+        future.add_done_callback(
+            functools.partial(_send_pay_button, chat_id, order_id, total_pence)
+        )
 
-            kb = InlineKeyboardMarkup()
-            kb.add(InlineKeyboardButton("💳 Pay Now", url=pay_url))
-            kb.add(InlineKeyboardButton("🛍 Make Another Order", callback_data="continue_order"))
+    # Save order as pending in CSV
+    write_order((
+        order_id,
+        callback.from_user.username or callback.from_user.first_name,
+        ", ".join(priced.items),
+        info["name"],
+        info["house"],
+        info["street"],
+        info["city"],
+        info["postcode"],
+        "pending",
+        datetime.now().strftime("%Y-%m-%d %H:%M"),
+        f"{total_pence / 100:.2f}",
+        CURRENCY,
+    ))
 
-            bot.send_message(
-                chat_id,
-                f"✅ Order *{order_id}* saved.\n"
-                f"💰 Total: {SYMBOL}{total:.2f}\n"
-                "Tap below to complete your payment securely:",
-                parse_mode="Markdown",
-                reply_markup=kb,
-            )
+    # Notify admins about new order
+    notify_admins(order_id, callback.from_user, priced, info)
 
-        except Exception as e:
-            # Fallback to manual payment if Stripe fails
-            bot.send_message(
-                chat_id,
-                "✅ Your order has been saved, but payment setup failed.\n"
-                "We'll contact you soon to arrange payment manually.\n"
-                f"Error: {e}",
-                parse_mode="Markdown",
-            )
-    else:
+    if not STRIPE_SECRET_KEY:
         # No Stripe: old behaviour
-        kb = InlineKeyboardMarkup()
-        kb.add(InlineKeyboardButton("🛍 Make Another Order", callback_data="continue_order"))
-
-        bot.send_message(
+        _rl_send(
             chat_id,
             f"✅ Order *{order_id}* saved.\n"
-            f"💰 Total: {SYMBOL}{total:.2f}\n"
+            f"💰 Total: {SYMBOL}{total_pence / 100:.2f}\n"
             "We'll contact you soon for payment.",
             parse_mode="Markdown",
-            reply_markup=kb,
+            reply_markup=_ANOTHER_ORDER_KB,
         )
 
     # Clear session after confirmation
@@ -909,61 +1679,121 @@ def confirm_order(callback):
 # ----------------------------------------------------------------------
 
 @bot.message_handler(commands=["maintenance_on"])
+@per_user
 def maintenance_on(message):
     global MAINTENANCE
     if not is_admin(message.from_user.id):
         return
     MAINTENANCE = True
-    bot.reply_to(message, "⚙️ Maintenance mode *enabled*.", parse_mode="Markdown")
+    _rl_reply(message, "⚙️ Maintenance mode *enabled*.", parse_mode="Markdown")
 
 
 @bot.message_handler(commands=["maintenance_off"])
+@per_user
 def maintenance_off(message):
     global MAINTENANCE
     if not is_admin(message.from_user.id):
         return
     MAINTENANCE = False
-    bot.reply_to(message, "✅ Maintenance mode *disabled*.", parse_mode="Markdown")
+    _rl_reply(message, "✅ Maintenance mode *disabled*.", parse_mode="Markdown")
+
+
+# Bound once so the line template is not re-parsed per row
+_LAST_ORDER_LINE = (
+    "• {order_id} — {username} — {status} — " + SYMBOL + "{order_total}"
+).format_map
 
 
 @bot.message_handler(commands=["last_orders"])
+@per_user
 def last_orders(message):
     if not is_admin(message.from_user.id):
         return
     try:
-        with open(csv_filename, "r", encoding="utf-8") as f:
-            rows = list(csv.DictReader(f))
-        if not rows:
-            bot.reply_to(message, "No orders found.")
+        recent = read_last_orders(5)
+        if not recent:
+            _rl_reply(message, "No orders found.")
             return
-        recent = rows[-5:]
-        text = "🧾 *Last 5 Orders:*\n\n"
+        parts = ["🧾 *Last 5 Orders:*\n"]
         for row in reversed(recent):
-            text += (
-                f"• {row['order_id']} — {row['username']} — "
-                f"{row['status']} — {SYMBOL}{row['order_total']}\n"
-            )
-        bot.reply_to(message, text, parse_mode="Markdown")
+            # Usernames like jack_r would otherwise break the Markdown reply
+            parts.append(_LAST_ORDER_LINE({k: escape_md(v) for k, v in row.items()}))
+        _rl_reply(message, "\n".join(parts), parse_mode="Markdown")
     except Exception as e:
-        bot.reply_to(message, f"⚠️ Error reading orders: {e}")
+        _rl_reply(message, f"⚠️ Error reading orders: {e}")
+
+
+# ----------------------------------------------------------------------
+# Fallbacks for text outside checkout (registered last so every command
+# handler above gets the first look)
+# ----------------------------------------------------------------------
+
+@bot.message_handler(content_types=["text"], regexp=r"^/")
+@per_user
+def unknown_command(message):
+    _rl_send(
+        message.chat.id,
+        "❓ Unknown command.\n"
+        "Use /order to browse, /cart to view your cart, or /restart to reset.",
+    )
+
+
+@bot.message_handler(content_types=["text"])
+@per_user
+def handle_other_text(message):
+    _rl_send(
+        message.chat.id,
+        "🛍 To start shopping, use /order.\n"
+        "To see your cart, use /cart.\n"
+        "If something feels stuck, use /restart.",
+    )
 
 
 # ----------------------------------------------------------------------
 # Run bot (polling or webhook)
 # ----------------------------------------------------------------------
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# The only update types the handlers above consume
+ALLOWED_UPDATES = ["message", "callback_query"]
 
 if __name__ == "__main__":
     if WEBHOOK_URL:
+        # Registers WEBHOOK_URL with Telegram, then serves pushed updates from
+        # an ASGI app (FastAPI + uvicorn) on that URL's path
         logger.info("🚀 Starting bot in WEBHOOK mode")
-        bot.remove_webhook()
-        bot.set_webhook(url=WEBHOOK_URL)
+        bot.run_webhooks(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            allowed_updates=ALLOWED_UPDATES,
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET,
+        )
     else:
         logger.info("💡 Starting bot in POLLING mode")
-        print("✅ Sticker Shop Bot running with Stripe Checkout & delivery rules...")
-        bot.infinity_polling(skip_pending=True, timeout=20, long_polling_timeout=20)
+        logger.info("✅ %s bot running with Stripe Checkout & delivery rules...", SHOP_NAME)
+        # Treat SIGTERM (systemd/docker stop) like Ctrl-C: telebot breaks out of
+        # the in-flight long poll on KeyboardInterrupt instead of waiting it out,
+        # and raising it can't be lost to infinity_polling's restart, which
+        # re-clears a stop_polling() flag. In-flight handlers then finish and
+        # atexit drains admin notifications, queued sends and orders.csv
+        # within docker's default 10 s grace period.
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        # getUpdates is refused while a webhook is registered
+        bot.remove_webhook()
+        try:
+            bot.infinity_polling(
+                skip_pending=True,
+                timeout=20,
+                long_polling_timeout=20,
+                allowed_updates=ALLOWED_UPDATES,
+            )
+        except KeyboardInterrupt:
+            # Landed between polls (e.g. infinity_polling's retry sleep)
+            pass
+        finally:
+            bot.stop_bot()
 
 
 # ----------------------------------------------------------------------
@@ -983,7 +1813,7 @@ def stripe_webhook():
     sig_header = request.headers.get("Stripe-Signature")
     endpoint_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
     try:
-        event = stripe.Webhook.construct_event(payload, sig_header, endpoint_secret)
+        event = _stripe().Webhook.construct_event(payload, sig_header, endpoint_secret)
     except Exception as e:
         return f"Webhook error: {e}", 400
 